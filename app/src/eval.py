@@ -1,3 +1,4 @@
+import asyncio
 import time
 import json
 from pdf import Pdf
@@ -16,73 +17,80 @@ queries = [
     "Tell me about thymic regeneration."
 ]
 
-def measure_query_speed(queries, log_file="query_logs.json"):
+async def run_one(query):
+    """
+    Runs retrieval and generation for a single query, timing each stage.
+
+    The blocking pdf/llm calls run in worker threads so independent queries
+    overlap instead of executing back to back.
+
+    Args:
+        query (str): The query string to evaluate.
+
+    Returns:
+        dict: The log entry for this query, including answer, metadata and timings.
+    """
+    print(f"Processing query: {query}")
+
+    # Measure query_chroma time
+    start = time.perf_counter()
+    context = await asyncio.to_thread(pdf.query_chroma, query, pdf.vector_store)
+    retrieved = time.perf_counter()
+    query_chroma_time = retrieved - start
+    print(f"query_chroma time: {query_chroma_time:.4f} seconds")
+
+    # Measure generate_answer time
+    answer = await asyncio.to_thread(llm.generate_answer, query, context)
+    generate_answer_time = time.perf_counter() - retrieved
+    print(f"generate_answer time: {generate_answer_time:.4f} seconds")
+
+    return {
+        "query": query,
+        "answer": answer,
+        "metadata": context['metadatas'] if 'metadatas' in context else [],
+        "paragraphs": context['documents'] if 'documents' in context else [],
+        "query_chroma_time": query_chroma_time,
+        "generate_answer_time": generate_answer_time
+    }
+
+async def measure_query_speed(queries, log_file="query_logs.jsonl"):
     """
     Measures the speed of query_chroma and generate_answer for a list of queries,
     logs the answers and metadata, and calculates the average time for each operation.
 
+    All queries run concurrently, so wall time approaches the slowest query
+    instead of the sum of all of them. Each log entry is streamed to the log
+    file as one compact JSON line the moment its query finishes, so partial
+    results survive a crash; read them back with json.loads per line.
+
     Args:
         queries (list): List of query strings.
-        log_file (str): Path to the file where logs will be saved.
+        log_file (str): Path to the JSONL file where logs will be saved.
 
     Returns:
         dict: A dictionary containing individual timings, answers, metadata, and averages.
     """
-    query_chroma_times = []
-    generate_answer_times = []
-    logs = []  # To store logs for each query
-
-    for query in queries:
-        print(f"Processing query: {query}")
-
-        # Measure query_chroma time
-        start_time = time.time()
-        context = pdf.query_chroma(query, pdf.vector_store)
-        end_time = time.time()
-        query_chroma_time = end_time - start_time
-        query_chroma_times.append(query_chroma_time)
-        print(f"query_chroma time: {query_chroma_time:.4f} seconds")
-
-        # Measure generate_answer time
-        start_time = time.time()
-        answer = llm.generate_answer(query, context)
-        end_time = time.time()
-        generate_answer_time = end_time - start_time
-        generate_answer_times.append(generate_answer_time)
-        print(f"generate_answer time: {generate_answer_time:.4f} seconds")
-
-        # Extract metadata and log
-        metadata = context['metadatas'] if 'metadatas' in context else []
-        chunks = context['documents'] if 'documents' in context else []
-        
-        logs.append({
-            "query": query,
-            "answer": answer,
-            "metadata": metadata,
-            "paragraphs": chunks,
-            "query_chroma_time": query_chroma_time,
-            "generate_answer_time": generate_answer_time
-        })
-
-    # Save logs to a file
-    with open(log_file, "w") as f:
-        json.dump(logs, f, indent=4)
-
-    # Calculate averages
-    avg_query_chroma_time = sum(query_chroma_times) / len(query_chroma_times)
-    avg_generate_answer_time = sum(generate_answer_times) / len(generate_answer_times)
+    logs = []
+    with open(log_file, "w", encoding="utf-8") as f:
+        for task in asyncio.as_completed([run_one(query) for query in queries]):
+            entry = await task
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+            logs.append(entry)
+
+    query_chroma_times = [log["query_chroma_time"] for log in logs]
+    generate_answer_times = [log["generate_answer_time"] for log in logs]
 
     # Return results
     return {
         "query_chroma_times": query_chroma_times,
         "generate_answer_times": generate_answer_times,
-        "avg_query_chroma_time": avg_query_chroma_time,
-        "avg_generate_answer_time": avg_generate_answer_time,
+        "avg_query_chroma_time": sum(query_chroma_times) / len(query_chroma_times),
+        "avg_generate_answer_time": sum(generate_answer_times) / len(generate_answer_times),
         "logs": logs
     }
 
 # Run the measurement
-results = measure_query_speed(queries, log_file="query_logs.json")
+results = asyncio.run(measure_query_speed(queries, log_file="query_logs.jsonl"))
 
 # Print results
 print("\n--- Results ---")
@@ -90,4 +98,4 @@ print(f"Query Chroma Times: {results['query_chroma_times']}")
 print(f"Generate Answer Times: {results['generate_answer_times']}")
 print(f"Average Query Chroma Time: {results['avg_query_chroma_time']:.4f} seconds")
 print(f"Average Generate Answer Time: {results['avg_generate_answer_time']:.4f} seconds")
-print(f"Logs saved to query_logs.json")
+print(f"Logs saved to query_logs.jsonl")
@@ -1,19 +1,129 @@
+import asyncio
+from contextlib import asynccontextmanager
+from itertools import chain
+
 from .pdf import Pdf
 from .llm import Llm
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from typing import List
 
 
-# Initialize the Profile and Llm classes
-pdf = Pdf()
-llm = Llm()
+class BatchQueue:
+    """
+    Coalesces concurrent queries into batched embedding and vector-store calls.
+
+    Requests arriving within a short window are drained together, embedded with
+    a single Ollama call and searched with a single ChromaDB query, then each
+    caller's future is resolved with its own slice of the results.
+    """
+
+    def __init__(self, pdf, window=0.05, max_batch=32):
+        """
+        Initializes the BatchQueue.
+
+        Args:
+            pdf (Pdf): The Pdf instance whose vector store is queried.
+            window (float): Seconds to wait for more requests before dispatching.
+            max_batch (int): Maximum number of queries per batch.
+        """
+        self.pdf = pdf
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+
+    async def submit(self, query_text):
+        """
+        Enqueues a query and waits for its retrieval result.
+
+        Args:
+            query_text (str): The query text to search for.
+
+        Returns:
+            dict: The retrieval results for this query (documents and metadatas).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query_text, future))
+        return await future
+
+    async def run(self):
+        """
+        Background task that drains the queue and dispatches batched searches.
+        """
+        while True:
+            query_text, future = await self.queue.get()
+            await asyncio.sleep(self.window)  # Let concurrent requests pile up
+            batch = [(query_text, future)]
+            while not self.queue.empty() and len(batch) < self.max_batch:
+                batch.append(self.queue.get_nowait())
+
+            queries = [item[0] for item in batch]
+            try:
+                # Blocking embed/query calls run off the event loop
+                results = await asyncio.to_thread(self._query_batch, queries)
+                for (_, fut), result in zip(batch, results):
+                    if not fut.done():
+                        fut.set_result(result)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    def _query_batch(self, queries):
+        """
+        Runs one batched embed + similarity search for all queries in the batch.
+
+        Args:
+            queries (list): The query texts in this batch.
+
+        Returns:
+            list: One result dict per query, shaped like a single-query
+                `query_chroma` response.
+        """
+        return self.pdf.query_chroma_batch(queries, self.pdf.vector_store)
+
+
+def _warmup(pdf, llm):
+    """
+    Issues dummy embedding and generation calls so the first real request
+    doesn't pay Ollama's model cold-start cost.
+
+    Args:
+        pdf (Pdf): The Pdf singleton whose embedding model to warm.
+        llm (Llm): The Llm singleton whose generation model to warm.
+    """
+    try:
+        pdf.generate_embedding_with_ollama("warmup")
+        llm.generate_answer("warmup", "warmup")
+    except Exception as e:
+        print(f"Model warmup failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Builds the Pdf and Llm singletons at startup instead of import time, warms
+    the models, and runs the request batcher for the app's lifetime.
+    """
+    app.state.pdf = await asyncio.to_thread(Pdf)
+    app.state.llm = Llm()
+    app.state.batcher = BatchQueue(app.state.pdf)
+    batcher_task = asyncio.create_task(app.state.batcher.run())
+    await asyncio.to_thread(_warmup, app.state.pdf, app.state.llm)
+    yield
+    batcher_task.cancel()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+def _get_llm(http_request: Request):
+    return http_request.app.state.llm
 
-# Initialize the LLM
-llm = Llm()
+
+def _get_batcher(http_request: Request):
+    return http_request.app.state.batcher
 
 # Define request and response models
 class QueryRequest(BaseModel):
@@ -30,7 +140,7 @@ class QueryResponse(BaseModel):
     
     
 @app.post("/api/query", response_model=QueryResponse)
-def query_llm(request: QueryRequest):
+async def query_llm(request: QueryRequest, llm=Depends(_get_llm), batcher=Depends(_get_batcher)):
     """
     Endpoint to handle user queries and return the LLM-generated response based on the provided context.
 
@@ -47,18 +157,16 @@ def query_llm(request: QueryRequest):
         4. Return the response, including the answer, metadata, and context.
     """
     try:
-        # Retrieve relevant context
-        context = pdf.query_chroma(request.query_text, pdf.vector_store)
-        # Generate the answer using the LLM
-        answer = llm.generate_answer(request.query_text, context)
+        # Retrieve relevant context via the batcher
+        context = await batcher.submit(request.query_text)
+        # Generate the answer using the LLM (off the event loop)
+        answer = await asyncio.to_thread(llm.generate_answer, request.query_text, context)
         
-        # Flatten the nested metadatas list
-        flattened_metadatas = [item for sublist in context['metadatas'] for item in sublist]
-
-        # Convert flattened metadata dictionaries to Metadata objects
+        # Flatten the nested metadatas list and build Metadata objects;
+        # model_construct skips validation since the values come from our own DB
         metadata_list = [
-            Metadata(doc_name=item['doc_name'], page=item['page_number'])
-            for item in flattened_metadatas
+            Metadata.model_construct(doc_name=item['doc_name'], page=item['page_number'])
+            for item in chain.from_iterable(context['metadatas'])
         ]
 
         # Return the response
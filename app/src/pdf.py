@@ -1,22 +1,136 @@
+import hashlib
 import os
+import pickle
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import diskcache
 import fitz
 import chromadb
 import ollama
+from rank_bm25 import BM25Okapi
+from sentence_transformers import CrossEncoder
+
+# Matches any run of whitespace (newlines, tabs, repeated spaces)
+_WS = re.compile(r"\s+")
+
+# Word tokens for the BM25 index and queries
+_TOKEN = re.compile(r"\w+")
+
+# Reciprocal-rank fusion constant; 60 is the standard value from the RRF paper
+_RRF_K = 60
+
+
+def _embedding_options():
+    """
+    Builds the Ollama options dict controlling embedding device placement.
+
+    EMBED_DEVICE=cuda (the default) offloads all model layers to the GPU;
+    EMBED_DEVICE=cpu keeps the model on CPU with one thread per core.
+
+    Returns:
+        dict: Options to pass to the Ollama embedding calls.
+    """
+    device = os.environ.get("EMBED_DEVICE", "cuda").lower()
+    return {
+        "num_gpu": 0 if device == "cpu" else 99,
+        "num_thread": os.cpu_count()
+    }
+
+
+# In-memory LRU of normalized query text -> embedding, shared by the single
+# and batched query paths
+_QUERY_CACHE_SIZE = 1024
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
+def _query_cache_get(text):
+    """
+    Looks up a normalized query in the embedding cache, refreshing its recency.
+
+    Args:
+        text (str): The normalized query text.
+
+    Returns:
+        tuple: The cached embedding vector, or None on a miss.
+    """
+    with _query_cache_lock:
+        embedding = _query_cache.get(text)
+        if embedding is not None:
+            _query_cache.move_to_end(text)
+        return embedding
+
+
+def _query_cache_put(text, embedding):
+    """
+    Stores a query embedding, evicting the least recently used entries.
+
+    Args:
+        text (str): The normalized query text.
+        embedding (list): The embedding vector to cache.
+    """
+    with _query_cache_lock:
+        _query_cache[text] = tuple(embedding)
+        _query_cache.move_to_end(text)
+        while len(_query_cache) > _QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+
+def _embed_text(text):
+    """
+    Embeds a single normalized text with Ollama, memoizing repeated inputs.
+
+    Args:
+        text (str): The normalized text to embed.
+
+    Returns:
+        tuple: The embedding vector as a tuple of floats.
+    """
+    embedding = _query_cache_get(text)
+    if embedding is None:
+        response = ollama.embeddings(model='nomic-embed-text', prompt=text, options=_embedding_options())
+        embedding = tuple(response["embedding"])
+        _query_cache_put(text, embedding)
+    return embedding
+
 
 class Pdf:
     """
     A class to handle PDF text extraction, embedding generation, and storage in a vector database.
     """
     
-    def __init__(self, resource_path="./resource", vector_store_path="./data/vector_store"):
+    def __init__(self, resource_path="./resource", vector_store_path="./data/vector_store",
+                 embed_cache_path="./data/embed_cache"):
         """
         Initializes the Pdf class.
 
         Args:
             resource_path (str): Path to the directory containing PDF files.
             vector_store_path (str): Path to the directory where the vector store is stored or will be created.
+            embed_cache_path (str): Path to the on-disk embedding cache.
         """
         self.vector_store_path = vector_store_path
+        # Persistent chunk-embedding cache keyed by content hash, so reindexing
+        # unchanged documents never re-embeds them
+        self._embed_cache = diskcache.Cache(embed_cache_path)
+        # Buffer of chunks waiting to be embedded and inserted in bulk
+        self._buffer = {"documents": [], "embeddings": [], "ids": [], "metadatas": []}
+        # Cross-encoder reranker; loaded eagerly so construction (which runs
+        # before the app serves traffic) pays the load cost, not the first
+        # query, and concurrent queries never race on a lazy init
+        self._reranker = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+        # Sparse BM25 index over chunk tokens, kept alongside the vector store
+        self._bm25 = None
+        self._bm25_corpus = []
+        self._bm25_path = os.path.join(vector_store_path, "bm25_index.pkl")
+        # Log which models Ollama has resident (and on which device)
+        try:
+            print(f"Ollama loaded models: {ollama.ps()}")
+        except Exception as e:
+            print(f"Could not query Ollama model status: {e}")
         # Load or create vector store
         self.vector_store = self._initialize_vector_store(resource_path)
         
@@ -51,24 +165,39 @@ class Pdf:
                     pdf_path = os.path.join(resource_path, filename)
                     print(f"Processing file: {pdf_path}")
                     self.process_pdf_page_by_page(pdf_path, collection)
+            # Build the sparse index over everything just ingested
+            self._build_bm25_index()
         else:
             print(f"Loading existing ChromaDB from '{persist_directory}'")
-        
-        return collection    
+            self._load_bm25_index(collection)
+
+        return collection
     
     def initialize_collection(self, persist_directory):
         """
         Initialize a ChromaDB client, loading the database if it exists, or creating it if not.
 
+        If the CHROMA_HOST environment variable is set, connects to a Chroma
+        server instead of embedding the database in-process, so sqlite and HNSW
+        writes run in the sidecar and never block this process. Start the
+        sidecar with: chroma run --path ./data/vector_store --host 0.0.0.0
+
         Args:
             persist_directory (str): Path to the directory where the database is stored.
 
         Returns:
             chroma.Collection: The collection for storing/retrieving embeddings.
         """
-        
-        # Initialize ChromaDB client
-        client = chromadb.PersistentClient(path=persist_directory)
+
+        # Initialize ChromaDB client (server mode if configured, else in-process)
+        chroma_host = os.environ.get("CHROMA_HOST")
+        if chroma_host:
+            client = chromadb.HttpClient(
+                host=chroma_host,
+                port=int(os.environ.get("CHROMA_PORT", "8000"))
+            )
+        else:
+            client = chromadb.PersistentClient(path=persist_directory)
 
         # Create or get collection
         collection_name = "pdf_chunks"
@@ -79,99 +208,348 @@ class Pdf:
         """
         Generates embeddings for a given text using the Ollama model.
 
+        Repeated texts (e.g. duplicate user queries) are served from an in-memory
+        LRU cache instead of paying the Ollama round trip again.
+
         Args:
             text (str): The text to embed.
 
         Returns:
             list: A list of floats representing the embedding vector.
         """
-        response = ollama.embeddings(model='nomic-embed-text', prompt=text)
-        embedding = response["embedding"]
-        return embedding
+        return list(_embed_text(text.strip().lower()))
+
+    def generate_embeddings_with_ollama(self, texts):
+        """
+        Generates embeddings for a batch of texts in a single Ollama call.
 
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: A list of embedding vectors, one per input text.
+        """
+        response = ollama.embed(model='nomic-embed-text', input=texts, options=_embedding_options())
+        return response["embeddings"]
+
+    def _embed_query_batch(self, queries):
+        """
+        Embeds query texts with the same normalization and LRU cache as the
+        single-query path; only cache misses go to Ollama, in one batched call.
+
+        Args:
+            queries (list): The query texts to embed.
+
+        Returns:
+            list: One embedding vector per query.
+        """
+        normalized = [query.strip().lower() for query in queries]
+        embeddings = [_query_cache_get(text) for text in normalized]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if misses:
+            fresh = self.generate_embeddings_with_ollama([normalized[i] for i in misses])
+            for i, embedding in zip(misses, fresh):
+                embeddings[i] = embedding
+                _query_cache_put(normalized[i], embedding)
+        return [list(embedding) for embedding in embeddings]
+
+    def _flush(self, collection, size=256):
+        """
+        Embeds and inserts all buffered chunks in one batched call.
+
+        Args:
+            collection (chroma.Collection): The ChromaDB collection to store embeddings.
+            size (int): Minimum buffer length before flushing; pass 0 to force a flush.
+        """
+        buffered = len(self._buffer["documents"])
+        if buffered == 0 or buffered < size:
+            return
+        # Serve chunks seen before (by content hash) from the on-disk cache and
+        # only embed the misses, in one batched call
+        documents = self._buffer["documents"]
+        keys = [hashlib.blake2b(doc.encode(), digest_size=16).hexdigest() for doc in documents]
+        embeddings = [self._embed_cache.get(key) for key in keys]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if misses:
+            fresh = self.generate_embeddings_with_ollama([documents[i] for i in misses])
+            for i, embedding in zip(misses, fresh):
+                embeddings[i] = embedding
+                self._embed_cache.set(keys[i], embedding)
+        collection.add(
+            documents=self._buffer["documents"],
+            metadatas=self._buffer["metadatas"],
+            ids=self._buffer["ids"],
+            embeddings=embeddings
+        )
+        # Keep every chunk for the sparse BM25 index built after ingestion
+        for chunk_id, document, metadata in zip(self._buffer["ids"], documents, self._buffer["metadatas"]):
+            self._bm25_corpus.append({"id": chunk_id, "document": document, "metadata": metadata})
+        self._buffer = {"documents": [], "embeddings": [], "ids": [], "metadatas": []}
+
+    def _build_bm25_index(self):
+        """
+        Builds the BM25 index over all ingested chunks and pickles it alongside
+        the vector store so later runs can load it without reprocessing.
+        """
+        if not self._bm25_corpus:
+            return
+        tokenized = [_TOKEN.findall(entry["document"].lower()) for entry in self._bm25_corpus]
+        self._bm25 = BM25Okapi(tokenized)
+        with open(self._bm25_path, "wb") as f:
+            pickle.dump({"bm25": self._bm25, "corpus": self._bm25_corpus}, f)
+
+    def _load_bm25_index(self, collection):
+        """
+        Loads the pickled BM25 index, rebuilding it from the already-ingested
+        collection when the pickle is missing (stores created before the index
+        existed) or unreadable.
+
+        Args:
+            collection (chroma.Collection): The populated ChromaDB collection.
+        """
+        if os.path.exists(self._bm25_path):
+            try:
+                with open(self._bm25_path, "rb") as f:
+                    payload = pickle.load(f)
+                self._bm25 = payload["bm25"]
+                self._bm25_corpus = payload["corpus"]
+                return
+            except Exception as e:
+                print(f"Could not load BM25 index: {e}")
+
+        print("Building BM25 index from the existing collection")
+        records = collection.get(include=["documents", "metadatas"])
+        self._bm25_corpus = [
+            {"id": chunk_id, "document": document, "metadata": metadata}
+            for chunk_id, document, metadata in zip(
+                records["ids"], records["documents"], records["metadatas"]
+            )
+        ]
+        self._build_bm25_index()
+
+    def _extract_page_chunks(self, pdf_document, page_number, chunk_size, overlap):
+        """
+        Extracts, normalizes and chunks the text of a single page.
+
+        Args:
+            pdf_document (fitz.Document): An open document handle owned by the
+                calling thread (PyMuPDF documents must not be shared across threads).
+            page_number (int): Zero-based page index to extract.
+            chunk_size (int): Number of characters in each chunk.
+            overlap (int): Number of characters to overlap between chunks.
+
+        Returns:
+            list: The text chunks for this page, in order.
+        """
+        try:
+            # Text-only extraction; skipping ligature preservation is slightly faster
+            text = pdf_document[page_number].get_text(
+                "text",
+                flags=fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+            )
+        except Exception as e:
+            print(f"Error processing page {page_number + 1}: {e}")
+            return []
+
+        if not text.strip():  # Skip empty pages
+            return []
+
+        # Collapse all whitespace runs to single spaces in one pass
+        text = _WS.sub(" ", text).strip()
+        # Precompute chunk start offsets; the stride keeps the overlap between chunks
+        step = chunk_size - overlap
+        return [text[start:start + chunk_size] for start in range(0, len(text), step)]
 
     def process_pdf_page_by_page(self, pdf_path, collection, chunk_size=3000, overlap=500):
         """
-        Processes a PDF file page by page, extracts text, chunks it, generates embeddings, 
+        Processes a PDF file page by page, extracts text, chunks it, generates embeddings,
         and stores them in the vector database.
 
+        Pages are independent after opening, so extraction and chunking run in a
+        thread pool; chunk ids are assigned in page order after the join so they
+        stay deterministic. Chunks are buffered and embedded in batches so the
+        per-call Ollama and ChromaDB overhead is paid once per batch instead of
+        once per chunk.
+
         Args:
             pdf_path (str): Path to the PDF file.
             collection (chroma.Collection): The ChromaDB collection to store embeddings.
             chunk_size (int): Number of characters in each chunk.
             overlap (int): Number of characters to overlap between chunks.
         """
-        pdf_name = pdf_path.split("/")[-1]  # Get the filename
+        pdf_name = os.path.basename(pdf_path)  # Get the filename
 
-        # Open the PDF with PyMuPDF
+        # Open the PDF once up front to validate it and count pages
         try:
             pdf_document = fitz.open(pdf_path)
+            page_count = len(pdf_document)
+            pdf_document.close()
         except Exception as e:
             print(f"Error opening PDF {pdf_path}: {e}")
             return
 
-        # Process each page individually
-        for page_number in range(len(pdf_document)):
-            try:
-                page = pdf_document[page_number]
-                text = page.get_text()
-
-                if not text.strip():  # Skip empty pages
-                    continue
+        # Each worker thread opens the document once and reuses the handle; the
+        # OS page cache already shares the file bytes across those handles
+        thread_state = threading.local()
+        open_documents = []
 
-                text = text.replace('\n', ' ').strip()  # Normalize text
-                start = 0
+        def extract(page_number):
+            document = getattr(thread_state, "document", None)
+            if document is None:
+                document = fitz.open(pdf_path)
+                thread_state.document = document
+                open_documents.append(document)
+            return self._extract_page_chunks(document, page_number, chunk_size, overlap)
 
-                # Process chunks for this page
-                while start < len(text):
-                    end = start + chunk_size
-                    chunk = text[start:end]
-                    start = end - overlap  # Ensure overlap for the next chunk
-
-                    # Prepare metadata for this chunk
-                    chunk_metadata = {
-                        "chunk_id": f"{pdf_name}_page{page_number + 1}_chunk{start}",
-                        "text": chunk,
+        # Extract and chunk pages in parallel, then join in page order
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            page_results = executor.map(extract, range(page_count))
+            for page_number, chunks in enumerate(page_results):
+                for chunk_idx, chunk in enumerate(chunks):
+                    self._buffer["documents"].append(chunk)
+                    self._buffer["metadatas"].append({
                         "doc_name": pdf_name,
                         "page_number": page_number + 1
-                    }
-
-                    # Generate embedding and store directly in ChromaDB
-                    embedding = self.generate_embedding_with_ollama(chunk)
-                    if embedding:
-                        collection.add(
-                            documents=[chunk],
-                            metadatas=[{
-                                "doc_name": chunk_metadata["doc_name"],
-                                "page_number": chunk_metadata["page_number"]
-                            }],
-                            ids=[chunk_metadata["chunk_id"]],
-                            embeddings=[embedding]
-                        )
-                        print(f"Stored chunk: {chunk_metadata['chunk_id']}")
+                    })
+                    self._buffer["ids"].append(f"{pdf_name}_p{page_number + 1}_c{chunk_idx}")
+                    self._flush(collection)
 
-            except Exception as e:
-                print(f"Error processing page {page_number + 1} of {pdf_path}: {e}")
+        # Flush any chunks left over after the final page
+        self._flush(collection, size=0)
 
-        pdf_document.close()
+        for document in open_documents:
+            document.close()
         print(f"----------Finished processing {pdf_path}----------")
         
-    def query_chroma(self, query_text, collection):
+    def _hybrid_candidates(self, query_text, dense_results, candidate_pool):
+        """
+        Fuses the dense candidate ranking with a BM25 ranking via
+        reciprocal-rank fusion, keeping the top candidates of the union.
+
+        Args:
+            query_text (str): The query the candidates were retrieved for.
+            dense_results (dict): A single-query ChromaDB query result.
+            candidate_pool (int): Number of fused candidates to keep.
+
+        Returns:
+            dict: A single-query-shaped result with the fused candidates.
+        """
+        if self._bm25 is None:
+            return dense_results
+
+        scores = {}
+        lookup = {}
+
+        dense_ids = dense_results["ids"][0]
+        for rank, chunk_id in enumerate(dense_ids):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (_RRF_K + rank + 1)
+            lookup[chunk_id] = (
+                dense_results["documents"][0][rank],
+                dense_results["metadatas"][0][rank]
+            )
+
+        bm25_scores = self._bm25.get_scores(_TOKEN.findall(query_text.lower()))
+        # Only chunks that actually match the query may earn fusion credit;
+        # zero-score chunks would otherwise rank on a par with dense hits
+        matching = [i for i, score in enumerate(bm25_scores) if score > 0]
+        sparse_top = sorted(
+            matching, key=bm25_scores.__getitem__, reverse=True
+        )[:candidate_pool]
+        for rank, corpus_idx in enumerate(sparse_top):
+            entry = self._bm25_corpus[corpus_idx]
+            scores[entry["id"]] = scores.get(entry["id"], 0.0) + 1.0 / (_RRF_K + rank + 1)
+            lookup.setdefault(entry["id"], (entry["document"], entry["metadata"]))
+
+        fused = sorted(scores, key=scores.get, reverse=True)[:candidate_pool]
+        return {
+            "ids": [fused],
+            "documents": [[lookup[chunk_id][0] for chunk_id in fused]],
+            "metadatas": [[lookup[chunk_id][1] for chunk_id in fused]]
+        }
+
+    def _rerank(self, query_text, results, n_results):
+        """
+        Reorders a single-query Chroma result with the cross-encoder and keeps
+        the top n, scoring all (query, document) pairs in one batched call.
+
+        Args:
+            query_text (str): The query the candidates were retrieved for.
+            results (dict): A single-query ChromaDB query result.
+            n_results (int): Number of top-scoring candidates to keep.
+
+        Returns:
+            dict: The result dict trimmed to the reranked top n.
+        """
+        documents = results["documents"][0]
+        if len(documents) <= n_results:
+            return results
+
+        scores = self._reranker.predict([(query_text, doc) for doc in documents])
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)[:n_results]
+
+        reranked = dict(results)
+        for key in ("documents", "metadatas", "ids", "distances"):
+            if reranked.get(key):
+                reranked[key] = [[reranked[key][0][i] for i in order]]
+        return reranked
+
+    def query_chroma(self, query_text, collection, n_results=3, candidate_pool=20):
         """
         Queries the vector database for the most relevant chunks based on the input query.
 
+        A wider candidate pool is fetched by embedding similarity and then
+        reranked with a cross-encoder, keeping only the top n for the LLM prompt.
+
         Args:
             query_text (str): The query text to search for.
             collection (chroma.Collection): The ChromaDB collection to search.
+            n_results (int): Number of top results to return after reranking.
+            candidate_pool (int): Number of candidates to fetch before reranking.
 
         Returns:
             dict: A dictionary containing the top results, including metadata and documents.
         """
         # Generate query embedding
         query_embedding = self.generate_embedding_with_ollama(query_text)
-        # Perform a similarity search
+        # Perform a similarity search over the wider candidate pool
         results = collection.query(
             query_embeddings=[query_embedding],
-            n_results=3  # Number of top results to retrieve
+            n_results=candidate_pool
+        )
+        # Fuse with the BM25 ranking, then rerank and keep the strongest candidates
+        results = self._hybrid_candidates(query_text, results, candidate_pool)
+        return self._rerank(query_text, results, n_results)
+
+    def query_chroma_batch(self, queries, collection, n_results=3, candidate_pool=20):
+        """
+        Queries the vector database for several queries in one batched search.
+
+        Query embeddings come from the shared LRU cache where possible, with
+        all misses embedded in a single Ollama call; the search itself is one
+        ChromaDB query, and each query's candidate pool is then reranked
+        independently.
+
+        Args:
+            queries (list): The query texts to search for.
+            collection (chroma.Collection): The ChromaDB collection to search.
+            n_results (int): Number of top results per query after reranking.
+            candidate_pool (int): Number of candidates to fetch per query before reranking.
+
+        Returns:
+            list: One result dict per query, each shaped like a `query_chroma` response.
+        """
+        embeddings = self._embed_query_batch(queries)
+        results = collection.query(
+            query_embeddings=embeddings,
+            n_results=candidate_pool
         )
-        return results
\ No newline at end of file
+        per_query = []
+        for i, query_text in enumerate(queries):
+            single = {
+                key: [results[key][i]]
+                for key in ("documents", "metadatas", "ids", "distances")
+                if results.get(key)
+            }
+            single = self._hybrid_candidates(query_text, single, candidate_pool)
+            per_query.append(self._rerank(query_text, single, n_results))
+        return per_query
\ No newline at end of file